@@ -1,12 +1,36 @@
 #!/bin/python3
-from os import path, scandir
+import sys
+from os import path, scandir, cpu_count, DirEntry
+from stat import S_ISREG
 from math import log10
-from fnmatch import fnmatch
+from bisect import bisect_right
+from re import compile as re_compile, IGNORECASE
+from fnmatch import translate
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
+try:
+    from os import O_RDONLY, O_DIRECTORY, open as os_open, close as os_close, supports_fd
+    # scandir on a descriptor stats the entries relative to it instead of resolving full paths
+    SCANDIR_FD = scandir in supports_fd
+except ImportError: # Windows
+    SCANDIR_FD = False
+
+# fnmatch folds case where the file system does (Windows), the compiled patterns do the same
+CASE_FLAGS = IGNORECASE if path.normcase("A") == "a" else 0
 
 PREFIX = (" ", "K", "M", "G", "T", "P")
 PREFIX_B = ("  ", "Ki", "Mi", "Gi", "Ti", "Pi")
+# scale -> (unit prefixes up to exa, the matching powers of the scale)
+SIZE_UNITS = {scale: (units, tuple(scale ** idx for idx in range(len(units))))
+    for scale, units in ((1000, PREFIX + ("E",)), (1024, PREFIX_B + ("Ei",)))}
+
+# number with optional ' ' or '_' separators, a size prefix and 'i' for binary. Anything after is ignored.
+SIZE_RE = re_compile(r"([\d._ ]+)(?:([KMGTPkmgtp])(i?).*)?")
+# a number (default 1) followed by a unit, bare numbers are seconds
+DURATION_RE = re_compile(r"([\d _]*)([^\d _]*)")
+
+output_lines = [] # -f and -d lines are written in batches, see print_line
 
 def round_significant(num, significant_digits):
     if not num: return 0
@@ -15,11 +39,10 @@ def round_significant(num, significant_digits):
     return num if rfact > 0 else int(num)
 
 def format_size(size, scale=1000, digits=3):
-    prefix = PREFIX if scale != 1024 else PREFIX_B
-    for S in prefix:
-        if size < scale: return (f"{round_significant(size, digits)}{S}").rjust(digits + 2 + len(S))
-        size /= scale
-    return f"{round_significant(size, digits)}E{'i' if scale == 1024 else ''}".rjust(digits + 2 + len(prefix[1]))
+    units, powers = SIZE_UNITS[scale]
+    idx = bisect_right(powers, size) - 1 if size >= scale else 0
+    S = units[idx]
+    return f"{round_significant(size / powers[idx] if idx else size, digits)}{S}".rjust(digits + 2 + len(S))
     
 def format_date(fdate, now, full_date = False):
     if fdate == None: return ""
@@ -39,26 +62,11 @@ def format_date(fdate, now, full_date = False):
     return date_str + ("T" if date_str and time_str else "") + time_str
     
 def to_int_size(size_str):
-    length = range(1, len(PREFIX))
-    number = ""
-    scale = 0
-    is_binary = False
-    for ch in size_str:
-        if scale > 0: # after scale unit is set, only accept 'i' for binary scale.
-            is_binary = ch == "i"
-            break
-        if ch == " " or ch == "_": continue #ignore white spaces or underscore (for thousands separator)
-        if "0" <= ch <= "9" or ch == ".": number += ch
-        else:
-            ch = ch.upper()
-            for idx in length:
-                if ch == PREFIX[idx]: 
-                    scale = idx
-                    break
-            else:
-                raise ValueError(f"Unknown symbol {ch} in {size_str}")
-   
-    return float(number) * (1024 if is_binary else 1000) ** scale
+    match = SIZE_RE.fullmatch(size_str)
+    if not match: raise ValueError(f"Cannot read a size from {size_str}")
+    number, unit, binary = match.groups()
+    scale = PREFIX.index(unit.upper()) if unit else 0
+    return float(number.replace(" ", "").replace("_", "")) * (1024 if binary else 1000) ** scale
 
 def to_int_date(date_str, now):
     try:
@@ -68,31 +76,13 @@ def to_int_date(date_str, now):
     
     units = {"y": 0, "year": 0, "M": 0, "month": 0, "w": 0, "week": 0, "d": 0, "day": 0,
             "h": 0, "hour": 0, "m": 0, "min": 0, "minute": 0,  "": 0, "sec": 0, "second": 0}
-    cur_int_str = ""
-    cur_unit_str = ""
-    is_unit = False
-    
-    def cut_num():
-        nonlocal is_unit, cur_int_str, cur_unit_str
-        if is_unit:
-            unit = cur_unit_str[0:-1] if cur_unit_str.endswith("s") else cur_unit_str
+    for number, unit in DURATION_RE.findall(date_str):
+        number = number.replace(" ", "").replace("_", "")
+        if unit:
+            unit = unit[0:-1] if unit.endswith("s") else unit
             if not unit in units: raise ValueError("Time unit not recognized! " + unit)
-            units[unit] += int(cur_int_str or 1)
-            cur_int_str = ""
-            cur_unit_str = ""
-            is_unit = False
-    
-    for ch in date_str:
-        if ch == " " or ch == "_": cut_num()
-        elif "0" <= ch <= "9":
-            cut_num()
-            cur_int_str += ch
-        else:
-            is_unit = True
-            cur_unit_str += ch
-
-    if is_unit: cut_num()
-    elif cur_int_str: units["sec"] += int(cur_int_str)
+            units[unit] += int(number or 1)
+        elif number: units["sec"] += int(number)
     
     delta = timedelta(
         days = units["d"] + units["day"] + 7*(units["w"] + units["week"]), 
@@ -110,22 +100,61 @@ def to_int_date(date_str, now):
 
     return (now.replace(year = year, month = month) - delta).timestamp()
 
-def and_match(fname, patterns, on_empty = True):
-    if not patterns: return on_empty
+def print_line(size_str, loc):
+    output_lines.append(f"{size_str} {loc}\n")
+    if len(output_lines) >= 512: flush_lines()
+
+def print_lines(lines):
+    output_lines.extend(lines)
+    if len(output_lines) >= 512: flush_lines()
+
+def flush_lines():
+    sys.stdout.write("".join(output_lines))
+    output_lines.clear()
+
+def split_patterns(patterns):
+    # patterns with a '/' match the folder path, patterns without wildcards are plain names
+    patterns = patterns or []
+    folder_globs = [p for p in patterns if "/" in p]
+    literals = [p for p in patterns if not "/" in p and not any(ch in p for ch in "*?[")]
+    names = {p.lower() for p in literals} if CASE_FLAGS else set(literals)
+    return names, [p for p in patterns if not p in literals and not "/" in p], folder_globs
+
+def compile_patterns(patterns):
+    return [re_compile(translate(p), CASE_FLAGS) for p in patterns or []]
+
+def compile_union(patterns):
+    return re_compile("|".join(translate(p) for p in patterns), CASE_FLAGS) if patterns else None
+
+def and_match(fname, names, patterns):
+    if names and (len(names) > 1 or not fname in names): return False
     for p in patterns:
-        if not fnmatch(fname, p): return False
+        if not p.match(fname): return False
     return True
 
-def or_match(fname, patterns, on_empty = True):
-    if not patterns: return on_empty
-    for p in patterns:
-        if fnmatch(fname, p): return True
-    return False
+def folder_match(loc, args):
+    # the folder patterns give the same result for every file in the folder, returns
+    # (every file rejected, --or matched, --not-all folder patterns matched)
+    if not args.has_folder_patterns: return False, False, True
+    # path below the starting folder, eg. 'venv/lib/', so the spelling of -p does not matter
+    folder = loc[len(args.path):].lstrip("/" + path.sep).replace(path.sep, "/")
+    if folder: folder += "/"
+    if args.insensitive: folder = folder.lower()
+    rejected = (args.not_any_folder_re != None and args.not_any_folder_re.match(folder) != None) or\
+        not and_match(folder, None, args.and_folder_re)
+    or_hit = args.or_folder_re != None and args.or_folder_re.match(folder) != None
+    return rejected, or_hit, and_match(folder, None, args.not_all_folder_re)
 
-def matches(fname, args):
-    if args.insensitive: fname = fname.lower()
-    return or_match(fname, args.or_any) and and_match(fname, args.and_all) and\
-        not or_match(fname, args.not_any, False) and not and_match(fname, args.not_all, False)
+def matches(fname, args, folder):
+    if args.match_all: return True
+    if args.insensitive or CASE_FLAGS: fname = fname.lower() # the literal names are folded too
+    _, or_hit, not_all_hit = folder
+    # rejecting groups first, exclusions like '*.pyc' usually end the check soonest
+    if fname in args.not_any_names or (args.not_any_re and args.not_any_re.match(fname)): return False
+    if args.not_all and not_all_hit and and_match(fname, args.not_all_names, args.not_all_re): return False
+    if not and_match(fname, args.and_names, args.and_re): return False
+    if not args.or_any or or_hit or fname in args.or_names: return True
+    return args.or_re != None and args.or_re.match(fname) != None
         
 def int_match_pair(min_limit, max_limit, value):
     if min_limit == None: return value <= max_limit if max_limit != None else True
@@ -133,37 +162,92 @@ def int_match_pair(min_limit, max_limit, value):
     return (min_limit <= value <= max_limit) if min_limit <= max_limit else not (max_limit < value < min_limit)
 
 def stat_match(stat, args):
+    if not args.has_stat_filter: return True
     return int_match_pair(args.min_bytes, args.max_bytes, stat.st_size) and\
             int_match_pair(args.min_date, args.max_date, stat.st_mtime)
 
-def process_directory(loc, args):
-    with scandir(loc) as it:
-        matched_size = 0
-        matched_in_subdirs = 0
-        matched_count = 0
-        total_files = 0
-        total_size = 0
-        for entry in it:
-            if entry.is_symlink():
-                if not args.follow_links: continue
-            if entry.is_dir():
-                msize, mcount, tsize, tcount = process_directory(entry.path, args)
-                matched_in_subdirs += msize
-                matched_count += mcount
-                total_size += tsize
-                total_files += tcount
-            elif entry.is_file():
-                stat = entry.stat()
-                fsize = stat.st_size
-                total_files += 1
-                total_size += fsize
-                if matches(entry.name, args) and stat_match(stat, args):
-                    if args.files: print(format_size(fsize, args.scale), entry.path)
-                    matched_size += fsize
-                    matched_count += 1
+def scan_directory(loc, args):
+    # attribute and global lookups are bound once, the loop runs for every entry
+    select_all = args.match_all and not args.has_stat_filter
+    follow_links = args.follow_links
+    files = args.files
+    scale = args.scale
+    insensitive = args.insensitive
+    prune_re = args.prune_re
+    join = path.join
+    _matches = matches
+    _stat_match = stat_match
+    _format_size = format_size
+    folder = folder_match(loc, args)
+    select_none = folder[0]
+    subdirs = []
+    lines = []
+    matched_size = 0
+    matched_count = 0
+    total_files = 0
+    total_size = 0
+    fd = os_open(loc, O_RDONLY | O_DIRECTORY) if SCANDIR_FD else None
+    try:
+        with scandir(loc if fd == None else fd) as it:
+            # inode order keeps the disk head moving forward on spinning disks
+            for entry in sorted(it, key=DirEntry.inode) if args.inode_order else it:
+                # links are neither folders nor regular files unless followed
+                if entry.is_dir(follow_symlinks=follow_links):
+                    if prune_re and prune_re.match(entry.name.lower() if insensitive else entry.name): continue
+                    subdirs.append(join(loc, entry.name))
+                else:
+                    # the stat needed for the size also tells if it is a regular file.
+                    # lstat is enough unless a link is followed, and it is free on Windows
+                    try: stat = entry.stat(follow_symlinks=follow_links)
+                    except OSError: continue # broken link
+                    if not S_ISREG(stat.st_mode): continue
+                    fsize = stat.st_size
+                    total_files += 1
+                    total_size += fsize
+                    if select_all or (not select_none and _matches(entry.name, args, folder) and _stat_match(stat, args)):
+                        if files: lines.append(f"{_format_size(fsize, scale)} {join(loc, entry.name)}\n")
+                        matched_size += fsize
+                        matched_count += 1
+    finally:
+        if fd != None: os_close(fd)
+    return subdirs, [matched_size, matched_count, total_size, total_files], lines
+
+def process_directory(root, args):
+    totals = {} # dir -> [matched size in dir, matched size, matched count, total size, total files]
+    stack = [(root, None, False)]
+    while stack:
+        loc, parent, done = stack.pop()
+        if done: # subdirectories are summed, pass the totals to the parent
+            sums = totals.pop(loc)
+            if args.directories: print_line(format_size(sums[0], args.scale), loc)
+            if parent == None: return tuple(sums[1:])
+            parent_sums = totals[parent]
+            for idx in range(1, 5): parent_sums[idx] += sums[idx]
+            continue
 
-    if args.directories: print(format_size(matched_size, args.scale), loc)
-    return matched_size + matched_in_subdirs, matched_count, total_size, total_files
+        subdirs, sums, lines = scan_directory(loc, args)
+        print_lines(lines)
+        totals[loc] = [sums[0]] + sums
+        stack.append((loc, parent, True))
+        stack.extend((subdir, loc, False) for subdir in reversed(subdirs))
+
+def process_parallel(root, args):
+    # directories are scanned in worker threads, the sums and lines are merged here
+    totals = [0, 0, 0, 0]
+    with ThreadPoolExecutor(args.jobs) as pool:
+        pending = {pool.submit(scan_directory, root, args)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    subdirs, sums, lines = future.result()
+                    print_lines(lines)
+                    for idx in range(4): totals[idx] += sums[idx]
+                    pending.update(pool.submit(scan_directory, subdir, args) for subdir in subdirs)
+        except BaseException: # a failed scan or Ctrl-C drops the queued scans instead of waiting for them
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    return tuple(totals)
 
 def process_args():
     parser = ArgumentParser(
@@ -173,7 +257,9 @@ def process_args():
             "(a or b or c) and (d and e) and not (w or x) and not (y and z), where a..z are patterns.\n"
             "Notice that unmarked patterns are added to the 'or' group except after the --not-all tag, which are "
             "added to the 'not-all' group. There is currently no way to form custom groupings. Also notice that 'sizeof X -a Y' "
-            "works as intended because how the groups are joined. More general way is 'sizeof -a X -a Y'.")
+            "works as intended because how the groups are joined. More general way is 'sizeof -a X -a Y'.\n"
+            "Patterns with a '/' are matched against the folder of the file relative to the starting location, with a "
+            "trailing '/' (eg. 'venv/lib/'), instead of its name. Eg. '-n venv/* -n */venv/*' rejects files in any venv folder.")
     parser.add_argument("patterns", metavar="P", nargs="*", default=[], help="if the first P is an existing folder, it's same as -p P, otherwise P's are equivalent to -o P")
     parser.add_argument("-d", "--directories", action="store_true", help="prints total matched size in each folder.")
     parser.add_argument("-f", "--files", action="store_true", help="prints the matched files.")
@@ -183,6 +269,10 @@ def process_args():
     parser.add_argument("-p", "--path", help="starting location, default is the current dir.")
     parser.add_argument("-b", "--binary", dest="scale", action="store_const", default=1000, const=1024, help="use binary instead of si units.")
     parser.add_argument("--follow-links", action="store_true", help="follow links pointing outside the path.")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+        help="scan N folders in parallel, helps on slow or network disks. 0 uses 4 per cpu (max 32). Ignored with -d.")
+    parser.add_argument("--inode-order", action="store_true", help="scan entries in inode order, faster on hard disks.")
+    parser.add_argument("--prune", metavar="P", action="append", default=[], help="skip folders whose name matches P, their files are not counted at all.")
     parser.add_argument("-i", "--insensitive", action="store_true", help="case insensitive matching.")
 #logical ops
     parser.add_argument("-a", "--and", dest="and_all", metavar="P", action="append", help=" (P1 & ... & Pn), select if all are matched.")
@@ -223,6 +313,8 @@ def process_args():
     if args.quiet:
         if args.verbose or args.files or args.directories or args.summary:
             parser.error("Cannot not use -v, -s, -d, or -f with -q")
+    if args.jobs < 0: parser.error("-j needs 0 (automatic) or a positive number of jobs")
+    if args.jobs == 0: args.jobs = min(32, (cpu_count() or 1) * 4)
     if args.verbose:
         args.files = True
         args.summary = True
@@ -231,6 +323,23 @@ def process_args():
         args.not_any = [x.lower() for x in (args.not_any or [])]
         args.and_all = [x.lower() for x in (args.and_all or [])]
         args.not_all = [x.lower() for x in (args.not_all or [])]
+        args.prune = [x.lower() for x in args.prune]
+    args.or_names, or_globs, or_folders = split_patterns(args.or_any)
+    args.and_names, and_globs, and_folders = split_patterns(args.and_all)
+    args.not_any_names, not_any_globs, not_any_folders = split_patterns(args.not_any)
+    args.not_all_names, not_all_globs, not_all_folders = split_patterns(args.not_all)
+    args.or_re = compile_union(or_globs)
+    args.and_re = compile_patterns(and_globs)
+    args.not_any_re = compile_union(not_any_globs)
+    args.not_all_re = compile_patterns(not_all_globs)
+    args.or_folder_re = compile_union(or_folders)
+    args.and_folder_re = compile_patterns(and_folders)
+    args.not_any_folder_re = compile_union(not_any_folders)
+    args.not_all_folder_re = compile_patterns(not_all_folders)
+    args.has_folder_patterns = bool(or_folders or and_folders or not_any_folders or not_all_folders)
+    args.prune_re = compile_union(args.prune)
+    args.match_all = not (args.or_any or args.and_all or args.not_any or args.not_all)
+    args.has_stat_filter = any(x != None for x in (args.min_bytes, args.max_bytes, args.min_date, args.max_date))
     return args
 
 def paren_array(array, join_str, pre_str = ""):
@@ -257,12 +366,17 @@ def print_patterns(args):
     date_lim = int_limits_str(args.min_date, args.max_date, "DATE", lambda x: format_date(x, args.now))
     res += f", {size_lim}" if size_lim else ""
     res += f", {date_lim}" if date_lim else ""
+    res += f", SKIP {paren_array(args.prune, ' or ')}" if args.prune else ""
     return res
 
 def main():
     args = process_args()
     if not args.quiet: print(f"IN {args.path} NAME {print_patterns(args)}")
-    m_size, m_count, t_size, t_count = process_directory(args.path, args)
+    walk = process_parallel if args.jobs > 1 and not args.directories else process_directory
+    try:
+        m_size, m_count, t_size, t_count = walk(args.path, args)
+    finally: # keep the lines found so far if the walk fails or is interrupted
+        flush_lines()
     if args.quiet:
         print(m_size)
         return